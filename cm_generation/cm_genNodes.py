@@ -124,6 +124,9 @@ class ObjectInputNode(CrowdMasterAGenTreeNode):
     bl_width_default = 200.0
 
     inputObject = StringProperty(name="Object")
+    shareGeometry = BoolProperty(name="Share Geometry",
+                                 description="Agents use the same mesh data as the input object instead of a copy (deferred geometry always shares mesh data)",
+                                 default=True)
 
     def init(self, context):
         self.outputs.new('GeoSocketType', "Geometry")
@@ -131,9 +134,11 @@ class ObjectInputNode(CrowdMasterAGenTreeNode):
 
     def draw_buttons(self, context, layout):
         layout.prop_search(self, "inputObject", context.scene, "objects")
+        layout.prop(self, "shareGeometry")
 
     def getSettings(self):
-        return {"inputObject": self.inputObject}
+        return {"inputObject": self.inputObject,
+                "shareGeometry": self.shareGeometry}
 
 
 class GroupInputNode(CrowdMasterAGenTreeNode):
@@ -144,15 +149,20 @@ class GroupInputNode(CrowdMasterAGenTreeNode):
     bl_width_default = 200.0
 
     inputGroup = StringProperty(name="Group")
+    shareGeometry = BoolProperty(name="Share Geometry",
+                                 description="Agents use the same mesh data as the objects in the group instead of copies (deferred geometry always shares mesh data)",
+                                 default=True)
 
     def init(self, context):
         self.outputs.new('GeoSocketType', "Geometry")
 
     def draw_buttons(self, context, layout):
         layout.prop_search(self, "inputGroup", bpy.data, "groups")
+        layout.prop(self, "shareGeometry")
 
     def getSettings(self):
-        return {"inputGroup": self.inputGroup}
+        return {"inputGroup": self.inputGroup,
+                "shareGeometry": self.shareGeometry}
 
 
 def updateDupDir(self, context):
@@ -17,6 +17,8 @@
 # along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
 # ##### END GPL LICENSE BLOCK #####
 
+import bisect
+import itertools
 import math
 import os
 import random
@@ -28,10 +30,12 @@ import time
 import bmesh
 import bpy
 import mathutils
+import numpy as np
 from mathutils import Euler
 
 from ..cm_channels import Path
-from ..libs.ins_octree import createOctreeFromBPYObjs
+from ..libs.ins_octree import boundingBoxFromBPY, createOctree
+from ..libs.ins_relax import relaxPoints, rotatePoints
 from ..libs.ins_vector import Vector
 from .. import cm_timings
 from .. import SCENE_OT_cm_agent_add
@@ -41,6 +45,48 @@ KDTree = mathutils.kdtree.KDTree
 
 tmpPathChannel = Path(None)
 
+
+def makeEmpty(name, location):
+    """Create an empty object without going through bpy.ops"""
+    e = bpy.data.objects.new(name, None)
+    e.location = location
+    return e
+
+
+def copyObject(obj, shareGeometry):
+    """Copy an object for a new agent. When shareGeometry is set the copy
+    uses the same mesh datablock as the original so material replacements
+    must be made with replaceMaterials which links them to the object"""
+    cp = obj.copy()
+    if obj.type == 'MESH' and not shareGeometry:
+        cp.data = obj.data.copy()
+    return cp
+
+
+def replaceMaterials(obj, materials, getMaterial):
+    """Replace the materials of obj that are named in materials. The slots
+    are switched to link to the object first as otherwise the new material
+    would be written into the (possibly shared) mesh data"""
+    for m in obj.material_slots:
+        if m.name in materials:
+            replacement = materials[m.name]
+            m.link = 'OBJECT'
+            m.material = getMaterial(replacement)
+
+
+def buildTree(root, buildRequest):
+    """Build a tree of Templates without recursing. Each template adds the
+    requests for its inputs to a list which is pushed onto the stack in
+    reverse so they are built in the same depth first order as before"""
+    stack = [(root, buildRequest)]
+    while stack:
+        template, request = stack.pop()
+        children = []
+        template.buildOnce(request, children)
+        children.reverse()
+        stack.extend(children)
+
+
 # ==================== Some base classes ====================
 
 
@@ -60,8 +106,19 @@ class Template():
 
     def build(self, buildRequest):
         """Called when this template is being used to modify the scene"""
+        buildTree(self, buildRequest)
+
+    def buildOnce(self, buildRequest, children):
+        """Modify the scene for this template only. Instead of building its
+        inputs it appends (template, request) pairs to children"""
         self.buildCount += 1
 
+    def batchBuild(self, requests, children):
+        """Called by templates that make many requests at once. Templates
+        that can handle a whole batch faster than one request at a time
+        override this"""
+        children.extend((self, r) for r in requests)
+
     def check(self):
         """Return true if the inputs and settings are correct"""
         return True
@@ -72,7 +129,8 @@ class TemplateRequest():
 
     def __init__(self):
         self.pos = Vector((0, 0, 0))
-        self.rot = Vector((0, 0, 0))
+        self._rot = Vector((0, 0, 0))
+        self._rotMatrix = None
         self.scale = 1
         self.tags = {}
         self.cm_group = "cm"
@@ -80,25 +138,69 @@ class TemplateRequest():
         self.materials = {}
         # Key: material to replace. Value: material to replace with
 
+        # tags and materials are shared between copies of a request and are
+        #   only copied when a request that doesn't own them changes them
+        self.tagsOwner = True
+        self.materialsOwner = True
+
+    @property
+    def rot(self):
+        return self._rot
+
+    @rot.setter
+    def rot(self, value):
+        self._rot = value
+        self._rotMatrix = None
+
+    def rotMatrix(self):
+        """The rotation matrix for rot. Only calculated once for each value
+        of rot and shared with copies of this request"""
+        if self._rotMatrix is None:
+            self._rotMatrix = Euler(self._rot, 'XYZ').to_matrix()
+        return self._rotMatrix
+
+    def shareRot(self, new):
+        new._rot = self._rot
+        new._rotMatrix = self._rotMatrix
+
+    def shareWith(self, new):
+        """Give new the same tags and materials dicts as this request"""
+        new.tags = self.tags
+        new.materials = self.materials
+        new.tagsOwner = False
+        new.materialsOwner = False
+        self.tagsOwner = False
+        self.materialsOwner = False
+
+    def setTag(self, name, value):
+        if not self.tagsOwner:
+            self.tags = self.tags.copy()
+            self.tagsOwner = True
+        self.tags[name] = value
+
+    def setMaterial(self, target, material):
+        if not self.materialsOwner:
+            self.materials = self.materials.copy()
+            self.materialsOwner = True
+        self.materials[target] = material
+
     def copy(self):
         new = TemplateRequest()
         new.pos = self.pos
-        new.rot = self.rot
+        self.shareRot(new)
         new.scale = self.scale
-        new.tags = self.tags.copy()
         new.cm_group = self.cm_group
-        new.materials = self.materials.copy()
+        self.shareWith(new)
         return new
 
     def toGeoTemplate(self, deferGeo, group):
         new = GeoRequest()
         new.pos = self.pos
-        new.rot = self.rot
+        self.shareRot(new)
         new.scale = self.scale
-        new.tags = self.tags.copy()
         new.cm_group = self.cm_group
         new.group = group
-        new.materials = self.materials.copy()
+        self.shareWith(new)
         new.deferGeo = deferGeo
         return new
 
@@ -108,10 +210,34 @@ class GeoTemplate(Template):
     GeoTemplates are a description of how to create some arrangement of
      geometry"""
 
+    def __init__(self, inputs, settings, bpyName):
+        Template.__init__(self, inputs, settings, bpyName)
+        self.materialCache = {}
+
     def build(self, buildRequest):
         """Called when this GeoTemplate is being used to modify the scene"""
         pass
 
+    def buildOnce(self, buildRequest, children):
+        """GeoTemplates are built recursively through build and must never be
+        added to the buildTree stack"""
+        raise Exception("CrowdMaster - GeoTemplate {} added to the build "
+                        "stack".format(self.bpyName))
+
+    def batchBuild(self, requests, children):
+        """See buildOnce"""
+        raise Exception("CrowdMaster - GeoTemplate {} added to the build "
+                        "stack".format(self.bpyName))
+
+    def getMaterial(self, name):
+        """Look up a material by name, only searching bpy.data.materials the
+        first time each name is used by this GeoTemplate"""
+        mat = self.materialCache.get(name)
+        if mat is None:
+            mat = bpy.data.materials[name]
+            self.materialCache[name] = mat
+        return mat
+
 
 class GeoRequest(TemplateRequest):
     """Passed between the children of GeoTemplate"""
@@ -120,17 +246,20 @@ class GeoRequest(TemplateRequest):
         TemplateRequest.__init__(self)
         self.deferGeo = False
         self.group = None
+        self.pendingLinks = []
+        # (object, group) pairs that are linked into the scene once the
+        #   whole geo tree for an agent has been built
 
     def copy(self):
         new = GeoRequest()
         new.pos = self.pos
-        new.rot = self.rot
+        self.shareRot(new)
         new.scale = self.scale
-        new.tags = self.tags.copy()
         new.cm_group = self.cm_group
         new.group = self.group
-        new.materials = self.materials.copy()
+        self.shareWith(new)
         new.deferGeo = self.deferGeo
+        new.pendingLinks = self.pendingLinks
         return new
 
 
@@ -150,22 +279,28 @@ class GeoReturn:
 class GeoTemplateOBJECT(GeoTemplate):
     """For placing objects into the scene"""
 
+    def __init__(self, inputs, settings, bpyName):
+        GeoTemplate.__init__(self, inputs, settings, bpyName)
+        self.cachedObject = None
+        self.cachedObjectName = None
+
     def build(self, buildRequest):
         t = time.time()
-        obj = bpy.context.scene.objects[self.settings["inputObject"]]
+        if self.cachedObjectName != self.settings["inputObject"]:
+            self.cachedObjectName = self.settings["inputObject"]
+            self.cachedObject = bpy.context.scene.objects[self.cachedObjectName]
+        obj = self.cachedObject
         if buildRequest.deferGeo:
+            # Deferred objects are copied by cm_place_deferred_geo which
+            # always shares the mesh data so shareGeometry is not stored
             cp = bpy.data.objects.new("Empty", None)
             cp.matrix_world = obj.matrix_world
             cp["cm_deferObj"] = obj.name
             cp["cm_materials"] = buildRequest.materials
         else:
-            cp = obj.copy()
-            for m in cp.material_slots:
-                if m.name in buildRequest.materials:
-                    replacement = buildRequest.materials[m.name]
-                    m.material = bpy.data.materials[replacement]
-        buildRequest.group.objects.link(cp)
-        bpy.context.scene.objects.link(cp)
+            cp = copyObject(obj, self.settings["shareGeometry"])
+            replaceMaterials(cp, buildRequest.materials, self.getMaterial)
+        buildRequest.pendingLinks.append((cp, buildRequest.group))
         cm_timings.placement["GeoTemplateOBJECT"] += time.time() - t
         cm_timings.placementNum["GeoTemplateOBJECT"] += 1
         return GeoReturn(cp)
@@ -181,9 +316,17 @@ class GeoTemplateOBJECT(GeoTemplate):
 class GeoTemplateGROUP(GeoTemplate):
     """For placing groups into the scene"""
 
+    def __init__(self, inputs, settings, bpyName):
+        GeoTemplate.__init__(self, inputs, settings, bpyName)
+        self.cachedGroup = None
+        self.cachedGroupName = None
+
     def build(self, buildRequest):
         t = time.time()
         dat = bpy.data
+        if self.cachedGroupName != self.settings["inputGroup"]:
+            self.cachedGroupName = self.settings["inputGroup"]
+            self.cachedGroup = dat.groups[self.cachedGroupName]
 
         pos = buildRequest.pos
         rot = buildRequest.rot
@@ -191,51 +334,47 @@ class GeoTemplateGROUP(GeoTemplate):
         group = buildRequest.group
         deferGeo = buildRequest.deferGeo
 
-        gp = [o for o in dat.groups[self.settings["inputGroup"]].objects]
-        group_objects = [o.copy() for o in gp]
+        gp = [o for o in self.cachedGroup.objects]
 
         def zaxis(x): return x.location[2]
 
         if deferGeo:
-            for obj in dat.groups[self.settings["inputGroup"]].objects:
+            for obj in gp:
                 if obj.type == 'ARMATURE':
                     newObj = obj.copy()
                     newObj.rotation_euler = rot
-                    newObj.scale = Vector((scale, scale, scale))
+                    newObj.scale = (scale, scale, scale)
                     newObj.location = pos
-                    group.objects.link(newObj)
-                    bpy.context.scene.objects.link(newObj)
+                    buildRequest.pendingLinks.append((newObj, group))
                     newObj["cm_deferGroup"] = {"group": self.settings["inputGroup"],
                                                "aName": obj.name}
                     newObj["cm_materials"] = buildRequest.materials
                     return GeoReturn(newObj)
-            bpy.ops.object.add(type='EMPTY',
-                               location=min(group_objects, key=zaxis).location)
-            e = bpy.context.object
-            group.objects.link(e)
+            e = makeEmpty("Empty", min(gp, key=zaxis).location)
+            buildRequest.pendingLinks.append((e, group))
             e["cm_deferGroup"] = {"group": self.settings["inputGroup"]}
             e["cm_materials"] = buildRequest.materials
             cm_timings.placement["GeoTemplateGROUP"] += time.time() - t
             cm_timings.placementNum["GeoTemplateGROUP"] += 1
             return GeoReturn(e)
 
+        shareGeometry = self.settings["shareGeometry"]
+        group_objects = [copyObject(o, shareGeometry) for o in gp]
+
         topObj = None
+        parentMap = {orig: cp for orig, cp in zip(gp, group_objects)}
 
         for obj in group_objects:
-            for m in obj.material_slots:
-                if m.name in buildRequest.materials:
-                    replacement = buildRequest.materials[m.name]
-                    m.material = bpy.data.materials[replacement]
+            replaceMaterials(obj, buildRequest.materials, self.getMaterial)
 
-            if obj.parent in gp:
-                obj.parent = group_objects[gp.index(obj.parent)]
+            if obj.parent in parentMap:
+                obj.parent = parentMap[obj.parent]
             else:
                 #obj.rotation_euler = Vector(obj.rotation_euler) + Vector(rot)
-                obj.scale = Vector((scale, scale, scale))
+                obj.scale = (scale, scale, scale)
                 obj.location += pos
 
-            group.objects.link(obj)
-            bpy.context.scene.objects.link(obj)
+            buildRequest.pendingLinks.append((obj, group))
             if obj.type == 'ARMATURE':
                 aName = obj.name
                 # TODO what if there is more than one armature?
@@ -250,12 +389,11 @@ class GeoTemplateGROUP(GeoTemplate):
                 topObj = obj
 
         if topObj is None:  # For if there is no armature object in the group
-            bpy.ops.object.add(type='EMPTY',
-                               location=min(group_objects, key=zaxis).location)
-            e = bpy.context.object
-            group.objects.link(e)
+            e = makeEmpty("Empty", min(group_objects, key=zaxis).location)
+            buildRequest.pendingLinks.append((e, group))
+            copies = set(group_objects)
             for obj in group_objects:
-                if obj.parent not in group_objects:
+                if obj.parent not in copies:
                     obj.location -= pos
                     obj.parent = e
             topObj = e
@@ -547,7 +685,7 @@ class GeoTemplatePARENT(GeoTemplate):
 class TemplateADDTOGROUP(Template):
     """Change the group that agents are added to"""
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
         scene = bpy.context.scene
         isFrozen = False
@@ -571,7 +709,7 @@ class TemplateADDTOGROUP(Template):
         newBuildRequest.cm_group = self.settings["groupName"]
         cm_timings.placement["TemplateADDTOGROUP"] += time.time() - t
         cm_timings.placementNum["TemplateADDTOGROUP"] += 1
-        self.inputs["Template"].build(newBuildRequest)
+        children.append((self.inputs["Template"], newBuildRequest))
 
     def check(self):
         if "Template" not in self.inputs:
@@ -588,20 +726,21 @@ class TemplateADDTOGROUP(Template):
 class TemplateRANDOMMATERIAL(Template):
     """Assign random materials"""
 
-    def build(self, buildRequest):
+    def __init__(self, inputs, settings, bpyName):
+        Template.__init__(self, inputs, settings, bpyName)
+        self.cumulativeWeights = list(itertools.accumulate(
+            w for m, w in self.settings["materialList"]))
+
+    def buildOnce(self, buildRequest, children):
         t = time.time()
         s = random.random() * self.settings["totalWeight"]
-        index = 0
-        mat = None
-        while mat is None:
-            s -= self.settings["materialList"][index][1]
-            if s <= 0:
-                mat = self.settings["materialList"][index][0]
-            index += 1
-        buildRequest.materials[self.settings["targetMaterial"]] = mat
+        index = bisect.bisect_left(self.cumulativeWeights, s)
+        index = min(index, len(self.cumulativeWeights) - 1)
+        mat = self.settings["materialList"][index][0]
+        buildRequest.setMaterial(self.settings["targetMaterial"], mat)
         cm_timings.placement["TemplateRANDOMMATERIAL"] += time.time() - t
         cm_timings.placementNum["TemplateRANDOMMATERIAL"] += 1
-        self.inputs["Template"].build(buildRequest)
+        children.append((self.inputs["Template"], buildRequest))
 
     def check(self):
         if "Template" not in self.inputs:
@@ -616,7 +755,7 @@ class TemplateRANDOMMATERIAL(Template):
 class TemplateAGENT(Template):
     """Create a CrowdMaster agent"""
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
         cm_groups = bpy.context.scene.cm_groups
         gpName = buildRequest.cm_group
@@ -641,11 +780,18 @@ class TemplateAGENT(Template):
             gret = self.inputs["Objects"].build(geoBuildRequest)
             cm_timings.placement["TemplateAGENT-Build"] += time.time() - t
             cm_timings.placementNum["TemplateAGENT-Build"] += 1
+
+            sceneObjects = bpy.context.scene.objects
+            for obj, group in geoBuildRequest.pendingLinks:
+                group.objects.link(obj)
+                sceneObjects.link(obj)
+            geoBuildRequest.pendingLinks.clear()
+
             topObj = gret.obj
 
             topObj.location = pos
             topObj.rotation_euler = rot
-            topObj.scale = Vector((scale, scale, scale))
+            topObj.scale = (scale, scale, scale)
 
             topObj["cm_randomMaterial"] = buildRequest.materials
 
@@ -690,11 +836,11 @@ class TemplateAGENT(Template):
 class TemplateSWITCH(Template):
     """Randomly (biased by "switchAmout") pick which of the inputs to use"""
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         if random.random() < self.settings["switchAmout"]:
-            self.inputs["Template 1"].build(buildRequest)
+            children.append((self.inputs["Template 1"], buildRequest))
         else:
-            self.inputs["Template 2"].build(buildRequest)
+            children.append((self.inputs["Template 2"], buildRequest))
 
     def check(self):
         if "Template 1" not in self.inputs:
@@ -715,7 +861,12 @@ class TemplateSWITCH(Template):
 class TemplateOFFSET(Template):
     """Modify the postion and/or the rotation of the request made"""
 
-    def build(self, buildRequest):
+    def __init__(self, inputs, settings, bpyName):
+        Template.__init__(self, inputs, settings, bpyName)
+        self.cachedObject = None
+        self.cachedObjectName = None
+
+    def buildOnce(self, buildRequest, children):
         t = time.time()
         nPos = Vector()
         nRot = Vector()
@@ -723,7 +874,10 @@ class TemplateOFFSET(Template):
             nPos = Vector(buildRequest.pos)
             nRot = Vector(buildRequest.rot)
         if self.settings["referenceObject"] != "":
-            refObj = bpy.data.objects[self.settings["referenceObject"]]
+            if self.cachedObjectName != self.settings["referenceObject"]:
+                self.cachedObjectName = self.settings["referenceObject"]
+                self.cachedObject = bpy.data.objects[self.cachedObjectName]
+            refObj = self.cachedObject
             nPos += refObj.location
             nRot += Vector(refObj.rotation_euler)
         nPos += self.settings["locationOffset"]
@@ -736,7 +890,7 @@ class TemplateOFFSET(Template):
         cm_timings.placement["TemplateOFFSET"] += time.time() - t
         cm_timings.placementNum["TemplateOFFSET"] += 1
 
-        self.inputs["Template"].build(buildRequest)
+        children.append((self.inputs["Template"], buildRequest))
 
     def check(self):
         if "Template" not in self.inputs:
@@ -754,7 +908,7 @@ class TemplateOFFSET(Template):
 class TemplateRANDOM(Template):
     """Randomly modify rotation and scale of the request made"""
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
         rotDiff = random.uniform(self.settings["minRandRot"],
                                  self.settings["maxRandRot"])
@@ -769,7 +923,7 @@ class TemplateRANDOM(Template):
         buildRequest.scale = newScale
         cm_timings.placement["TemplateRANDOM"] += time.time() - t
         cm_timings.placementNum["TemplateRANDOM"] += 1
-        self.inputs["Template"].build(buildRequest)
+        children.append((self.inputs["Template"], buildRequest))
 
     def check(self):
         if "Template" not in self.inputs:
@@ -787,10 +941,16 @@ class TemplatePOINTTOWARDS(Template):
     def __init__(self, inputs, settings, bpyName):
         Template.__init__(self, inputs, settings, bpyName)
         self.kdtree = None
+        self.inverseWorld = None
+        self.cachedObject = None
+        self.cachedObjectName = None
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
-        ob = bpy.context.scene.objects[self.settings["PointObject"]]
+        if self.cachedObjectName != self.settings["PointObject"]:
+            self.cachedObjectName = self.settings["PointObject"]
+            self.cachedObject = bpy.context.scene.objects[self.cachedObjectName]
+        ob = self.cachedObject
         pos = buildRequest.pos
         if self.settings["PointType"] == "OBJECT":
             point = ob.location
@@ -801,14 +961,15 @@ class TemplatePOINTTOWARDS(Template):
                 for i, v in enumerate(mesh.vertices):
                     self.kdtree.insert(v.co, i)
                 self.kdtree.balance()
-            co, ind, dist = self.kdtree.find(ob.matrix_world.inverted() * pos)
+                self.inverseWorld = ob.matrix_world.inverted()
+            co, ind, dist = self.kdtree.find(self.inverseWorld * pos)
             point = ob.matrix_world * co
         direc = point - pos
         rotQuat = direc.to_track_quat('Y', 'Z')
         buildRequest.rot = rotQuat.to_euler()
         cm_timings.placement["TemplatePOINTTOWARDS"] += time.time() - t
         cm_timings.placementNum["TemplatePOINTTOWARDS"] += 1
-        self.inputs["Template"].build(buildRequest)
+        children.append((self.inputs["Template"], buildRequest))
 
     def check(self):
         if self.settings["PointObject"] not in bpy.context.scene.objects:
@@ -828,81 +989,64 @@ class TemplatePOINTTOWARDS(Template):
 class TemplateCOMBINE(Template):
     """Duplicate request to all inputs"""
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         for name, inp in self.inputs.items():
             newBuildRequest = buildRequest.copy()
-            inp.build(newBuildRequest)
+            children.append((inp, newBuildRequest))
 
 
 class TemplateRANDOMPOSITIONING(Template):
     """Place randomly"""
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
-        positions = []
-        for a in range(self.settings["noToPlace"]):
-            if self.settings["locationType"] == "radius":
-                angle = random.uniform(-math.pi, math.pi)
-                x = math.sin(angle)
-                y = math.cos(angle)
-                length = random.random() + random.random()
-                if length > 1:
-                    length = 2 - length
-                length *= self.settings["radius"]
-                x *= length
-                y *= length
-                diff = Vector((x, y, 0))
-                diff.rotate(mathutils.Euler(buildRequest.rot))
-                newPos = Vector(buildRequest.pos) + diff
-                positions.append(newPos)
-            elif self.settings["locationType"] == "area":
-                MaxX = self.settings["MaxX"] / 2
-                MaxY = self.settings["MaxY"] / 2
-                x = random.uniform(-MaxX, MaxX)
-                y = random.uniform(-MaxY, MaxY)
-                diff = Vector((x, y, 0))
-                newPos = Vector(buildRequest.pos) + diff
-                positions.append(newPos)
-            elif self.settings["locationType"] == "sector":
-                direc = self.settings["direc"]
-                angVar = self.settings["angle"] / 2
-                angle = random.uniform(-angVar, angVar)
-                x = math.sin(math.radians(angle + direc))
-                y = math.cos(math.radians(angle + direc))
-                length = random.random() + random.random()
-                if length > 1:
-                    length = 2 - length
-                length *= self.settings["radius"]
-                x *= length
-                y *= length
-                diff = Vector((x, y, 0))
-                diff.rotate(mathutils.Euler(buildRequest.rot))
-                newPos = Vector(buildRequest.pos) + diff
-                positions.append(newPos)
-        if self.settings["relax"]:
-            radius = self.settings["relaxRadius"]
-            for i in range(self.settings["relaxIterations"]):
-                kd = KDTree(len(positions))
-                for n, p in enumerate(positions):
-                    kd.insert(p, n)
-                kd.balance()
-                for n, p in enumerate(positions):
-                    adjust = Vector()
-                    localPoints = kd.find_range(p, radius * 2)
-                    for (co, ind, dist) in localPoints:
-                        if ind != n:
-                            v = p - co
-                            if v.length > 0:
-                                adjust += v * \
-                                    ((2 * radius - v.length) / v.length)
-                    if len(localPoints) > 0:
-                        positions[n] += adjust / len(localPoints)
+        settings = self.settings
+        locationType = settings["locationType"]
+        noToPlace = settings["noToPlace"]
+        rand = random.random
+        uniform = random.uniform
+        sin = math.sin
+        cos = math.cos
+        sqrt = math.sqrt
+
+        # Offsets from buildRequest.pos, one row per agent
+        offsets = np.zeros((noToPlace, 3))
+        if locationType == "radius":
+            radius = settings["radius"]
+            for a in range(noToPlace):
+                angle = uniform(-math.pi, math.pi)
+                length = sqrt(rand()) * radius
+                offsets[a, 0] = sin(angle) * length
+                offsets[a, 1] = cos(angle) * length
+        elif locationType == "area":
+            MaxX = settings["MaxX"] / 2
+            MaxY = settings["MaxY"] / 2
+            for a in range(noToPlace):
+                offsets[a, 0] = uniform(-MaxX, MaxX)
+                offsets[a, 1] = uniform(-MaxY, MaxY)
+        elif locationType == "sector":
+            radius = settings["radius"]
+            direc = settings["direc"]
+            angVar = settings["angle"] / 2
+            for a in range(noToPlace):
+                angle = math.radians(uniform(-angVar, angVar) + direc)
+                length = sqrt(rand()) * radius
+                offsets[a, 0] = sin(angle) * length
+                offsets[a, 1] = cos(angle) * length
+        if locationType != "area":
+            offsets = rotatePoints(offsets, buildRequest.rotMatrix())
+        positions = offsets + np.array(buildRequest.pos)
+        if settings["relax"]:
+            relaxPoints(positions, settings["relaxRadius"],
+                        settings["relaxIterations"])
         cm_timings.placement["TemplateRANDOMPOSITIONING"] += time.time() - t
         cm_timings.placementNum["TemplateRANDOMPOSITIONING"] += 1
+        newRequests = []
         for newPos in positions:
             newBuildRequest = buildRequest.copy()
-            newBuildRequest.pos = newPos
-            self.inputs["Template"].build(newBuildRequest)
+            newBuildRequest.pos = Vector(newPos)
+            newRequests.append(newBuildRequest)
+        self.inputs["Template"].batchBuild(newRequests, children)
 
     def check(self):
         if "Template" not in self.inputs:
@@ -921,10 +1065,15 @@ class TemplateMESHPOSITIONING(Template):
         Template.__init__(self, inputs, settings, bpyName)
         self.bvhtree = None
         self.totalArea = None
+        self.cachedObject = None
+        self.cachedObjectName = None
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
-        guide = bpy.data.objects[self.settings["guideMesh"]]
+        if self.cachedObjectName != self.settings["guideMesh"]:
+            self.cachedObjectName = self.settings["guideMesh"]
+            self.cachedObject = bpy.data.objects[self.cachedObjectName]
+        guide = self.cachedObject
         data = guide.data
 
         wrld = guide.matrix_world
@@ -946,7 +1095,7 @@ class TemplateMESHPOSITIONING(Template):
                     if self.settings["overwritePosition"]:
                         pos = wrld * pos
                     else:
-                        pos.rotate(mathutils.Euler(buildRequest.rot))
+                        pos = buildRequest.rotMatrix() * pos
                         pos *= buildRequest.scale
                         pos = buildRequest.pos + pos
                     positions.append(pos)
@@ -954,9 +1103,8 @@ class TemplateMESHPOSITIONING(Template):
 
         if self.settings["relax"]:
             sce = bpy.context.scene
-            gnd = sce.objects[self.settings["guideMesh"]]
             if self.bvhtree is None:
-                self.bvhtree = BVHTree.FromObject(gnd, sce)
+                self.bvhtree = BVHTree.FromObject(guide, sce)
             radius = self.settings["relaxRadius"]
             for i in range(self.settings["relaxIterations"]):
                 kd = KDTree(len(positions))
@@ -979,10 +1127,12 @@ class TemplateMESHPOSITIONING(Template):
         cm_timings.placement["TemplateMESHPOSITIONING"] += time.time() - t
         cm_timings.placementNum["TemplateMESHPOSITIONING"] += 1
 
+        newRequests = []
         for newPos in positions:
             newBuildRequest = buildRequest.copy()
             newBuildRequest.pos = newPos
-            self.inputs["Template"].build(newBuildRequest)
+            newRequests.append(newBuildRequest)
+        self.inputs["Template"].batchBuild(newRequests, children)
 
     def check(self):
         if "Template" not in self.inputs:
@@ -1005,11 +1155,16 @@ class TemplateVCOLPOSITIONING(Template):
         Template.__init__(self, inputs, settings, bpyName)
         self.bvhtree = None
         self.totalArea = None
+        self.cachedObject = None
+        self.cachedObjectName = None
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
         paintMode = self.settings["paintMode"]
-        guide = bpy.data.objects[self.settings["guideMesh"]]
+        if self.cachedObjectName != self.settings["guideMesh"]:
+            self.cachedObjectName = self.settings["guideMesh"]
+            self.cachedObject = bpy.data.objects[self.cachedObjectName]
+        guide = self.cachedObject
         invert = self.settings["invert"]
         data = guide.data
         polys = []
@@ -1049,7 +1204,7 @@ class TemplateVCOLPOSITIONING(Template):
                         if self.settings["overwritePosition"]:
                             pos = wrld * pos
                         else:
-                            pos.rotate(mathutils.Euler(buildRequest.rot))
+                            pos = buildRequest.rotMatrix() * pos
                             pos *= buildRequest.scale
                             pos = buildRequest.pos + pos
                         positions.append(pos)
@@ -1057,9 +1212,8 @@ class TemplateVCOLPOSITIONING(Template):
 
             if self.settings["relax"]:
                 sce = bpy.context.scene
-                gnd = sce.objects[self.settings["guideMesh"]]
                 if self.bvhtree is None:
-                    self.bvhtree = BVHTree.FromObject(gnd, sce)
+                    self.bvhtree = BVHTree.FromObject(guide, sce)
                 radius = self.settings["relaxRadius"]
                 for n, p in enumerate(positions):
                     rvec = random.random() * mathutils.noise.random_unit_vector()
@@ -1085,16 +1239,17 @@ class TemplateVCOLPOSITIONING(Template):
             cm_timings.placement["TemplateVCOLPOSITIONING"] += time.time() - t
             cm_timings.placementNum["TemplateVCOLPOSITIONING"] += 1
 
+            newRequests = []
             for newPos in positions:
                 newBuildRequest = buildRequest.copy()
                 newBuildRequest.pos = newPos
-                self.inputs["Template"].build(newBuildRequest)
+                newRequests.append(newBuildRequest)
+            self.inputs["Template"].batchBuild(newRequests, children)
 
         elif paintMode == 'edit':
             sce = bpy.context.scene
-            gnd = sce.objects[self.settings["guideMesh"]]
             if self.bvhtree is None:
-                self.bvhtree = BVHTree.FromObject(gnd, sce)
+                self.bvhtree = BVHTree.FromObject(guide, sce)
 
             point = buildRequest.pos
             loc, norm, ind, dist = self.bvhtree.find_nearest(point)
@@ -1107,10 +1262,10 @@ class TemplateVCOLPOSITIONING(Template):
                 loop_vert_index = mesh.loops[loop_index].vertex_index
                 if not invert:
                     if vcol_layer.data[loop_index].color == self.settings["vcolor"]:
-                        self.inputs["Template"].build(buildRequest)
+                        children.append((self.inputs["Template"], buildRequest))
                 else:
                     if not vcol_layer.data[loop_index].color == self.settings["vcolor"]:
-                        self.inputs["Template"].build(buildRequest)
+                        children.append((self.inputs["Template"], buildRequest))
 
     def check(self):
         if "Template" not in self.inputs:
@@ -1136,7 +1291,7 @@ def assignConnectedToIsland(vert, islandID, islandNo):
 class TemplatePATH(Template):
     """Place along a path"""
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
 
         pathEntry = bpy.context.scene.cm_paths.coll.get(
@@ -1223,6 +1378,7 @@ class TemplatePATH(Template):
         cm_timings.placement["TemplatePATH"] += time.time() - t
         cm_timings.placementNum["TemplatePATH"] += 1
 
+        newRequests = []
         for newPos, newRot, island in positions:
             newBuildRequest = buildRequest.copy()
             newBuildRequest.pos = newPos + buildRequest.pos
@@ -1230,39 +1386,42 @@ class TemplatePATH(Template):
             if self.settings["groupByMeshIsland"]:
                 newBuildRequest.cm_group += "_" + self.settings["nodeName"] + \
                                             "_" + str(island)
-            self.inputs["Template"].build(newBuildRequest)
+            newRequests.append(newBuildRequest)
+        self.inputs["Template"].batchBuild(newRequests, children)
 
 
 class TemplateFORMATION(Template):
     """Place in a row"""
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
 
         placePos = Vector(buildRequest.pos)
-        diffRow = Vector((self.settings["ArrayRowMargin"], 0, 0))
-        diffCol = Vector((0, self.settings["ArrayColumnMargin"], 0))
-        diffRow.rotate(mathutils.Euler(buildRequest.rot))
-        diffCol.rotate(mathutils.Euler(buildRequest.rot))
+        rotMatrix = buildRequest.rotMatrix()
+        diffRow = rotMatrix * Vector((self.settings["ArrayRowMargin"], 0, 0))
+        diffCol = rotMatrix * Vector((0, self.settings["ArrayColumnMargin"], 0))
         diffRow *= buildRequest.scale
         diffCol *= buildRequest.scale
         number = self.settings["noToPlace"]
         rows = self.settings["ArrayRows"]
 
+        # Slots fill each column before moving on to the next so the
+        #   left over slots end up in a partial last column
+        slots = np.arange(number)
+        cols = (slots // rows)[:, None]
+        rowNums = (slots % rows)[:, None]
+        positions = (np.array(placePos) + cols * np.array(diffCol) +
+                     rowNums * np.array(diffRow))
+
         cm_timings.placement["TemplateFORMATION"] += time.time() - t
         cm_timings.placementNum["TemplateFORMATION"] += 1
 
-        for fullcols in range(number // rows):
-            for row in range(rows):
-                newBuildRequest = buildRequest.copy()
-                newBuildRequest.pos = placePos + fullcols * diffCol + row * diffRow
-                self.inputs["Template"].build(newBuildRequest)
-
-        for leftOver in range(number % rows):
-            newBuild = buildRequest.copy()
-            newBuild.pos = placePos + \
-                (number // rows) * diffCol + leftOver * diffRow
-            self.inputs["Template"].build(newBuild)
+        newRequests = []
+        for newPos in positions:
+            newBuildRequest = buildRequest.copy()
+            newBuildRequest.pos = Vector(newPos)
+            newRequests.append(newBuildRequest)
+        self.inputs["Template"].batchBuild(newRequests, children)
 
     def check(self):
         if "Template" not in self.inputs:
@@ -1277,40 +1436,50 @@ class TemplateFORMATION(Template):
 class TemplateTARGET(Template):
     """Place based on the positions of vertices"""
 
-    def build(self, buildRequest):
+    def __init__(self, inputs, settings, bpyName):
+        Template.__init__(self, inputs, settings, bpyName)
+        self.cachedGroup = None
+        self.cachedGroupName = None
+        self.cachedObject = None
+        self.cachedObjectName = None
+
+    def buildOnce(self, buildRequest, children):
         t = time.time()
+        newRequests = []
         if self.settings["targetType"] == "object":
-            objs = bpy.data.groups[self.settings["targetGroups"]].objects
+            if self.cachedGroupName != self.settings["targetGroups"]:
+                self.cachedGroupName = self.settings["targetGroups"]
+                self.cachedGroup = bpy.data.groups[self.cachedGroupName]
+            objs = self.cachedGroup.objects
+            # float32 matches the properties so foreach_get can copy the
+            #   data directly into the arrays
+            locs = np.empty(len(objs) * 3, dtype=np.float32)
+            rots = np.empty(len(objs) * 3, dtype=np.float32)
+            objs.foreach_get("location", locs)
+            objs.foreach_get("rotation_euler", rots)
+            locs = locs.reshape(-1, 3)
+            rots = rots.reshape(-1, 3)
             if self.settings["overwritePosition"]:
-                for obj in objs:
+                for loc, oRot in zip(locs, rots):
                     newBuildRequest = buildRequest.copy()
-                    newBuildRequest.pos = obj.location
-                    newBuildRequest.rot = Vector(obj.rotation_euler)
-
-                    cm_timings.placement[
-                        "TemplateTARGET"] += time.time() - t
-
-                    self.inputs["Template"].build(newBuildRequest)
-
-                    t = time.time()
+                    newBuildRequest.pos = Vector(loc)
+                    newBuildRequest.rot = Vector(oRot)
+                    newRequests.append(newBuildRequest)
             else:
-                for obj in objs:
-                    loc = obj.location
-                    oRot = Vector(obj.rotation_euler)
-                    loc.rotate(mathutils.Euler(buildRequest.rot))
-                    loc *= buildRequest.scale
+                locs = rotatePoints(locs, buildRequest.rotMatrix())
+                locs *= buildRequest.scale
+                locs += np.array(buildRequest.pos)
+                rots = rots + np.array(buildRequest.rot)
+                for loc, oRot in zip(locs, rots):
                     newBuildRequest = buildRequest.copy()
-                    newBuildRequest.pos = loc + buildRequest.pos
-                    newBuildRequest.rot = buildRequest.rot + oRot
-
-                    cm_timings.placement[
-                        "TemplateTARGET"] += time.time() - t
-
-                    self.inputs["Template"].build(newBuildRequest)
-
-                    t = time.time()
+                    newBuildRequest.pos = Vector(loc)
+                    newBuildRequest.rot = Vector(oRot)
+                    newRequests.append(newBuildRequest)
         else:  # targetType == "vertex"
-            obj = bpy.data.objects[self.settings["targetObject"]]
+            if self.cachedObjectName != self.settings["targetObject"]:
+                self.cachedObjectName = self.settings["targetObject"]
+                self.cachedObject = bpy.data.objects[self.cachedObjectName]
+            obj = self.cachedObject
             if self.settings["overwritePosition"]:
                 wrld = obj.matrix_world
                 targets = [wrld * v.co for v in obj.data.vertices]
@@ -1319,28 +1488,24 @@ class TemplateTARGET(Template):
                     newBuildRequest = buildRequest.copy()
                     newBuildRequest.pos = vert
                     newBuildRequest.rot = newRot
-
-                    cm_timings.placement[
-                        "TemplateTARGET"] += time.time() - t
-
-                    self.inputs["Template"].build(newBuildRequest)
-
-                    t = time.time()
+                    newRequests.append(newBuildRequest)
             else:
-                targets = [Vector(v.co) for v in obj.data.vertices]
+                verts = obj.data.vertices
+                # float32 matches the "co" property so foreach_get can copy
+                #   the data directly into the array
+                targets = np.empty(len(verts) * 3, dtype=np.float32)
+                verts.foreach_get("co", targets)
+                targets = rotatePoints(targets.reshape(-1, 3),
+                                       buildRequest.rotMatrix())
+                targets *= buildRequest.scale
+                targets += np.array(buildRequest.pos)
                 for loc in targets:
-                    loc.rotate(mathutils.Euler(buildRequest.rot))
-                    loc *= buildRequest.scale
                     newBuildRequest = buildRequest.copy()
-                    newBuildRequest.pos = loc + buildRequest.pos
-
-                    cm_timings.placement[
-                        "TemplateTARGET"] += time.time() - t
-
-                    self.inputs["Template"].build(newBuildRequest)
-
-                    t = time.time()
+                    newBuildRequest.pos = Vector(loc)
+                    newRequests.append(newBuildRequest)
+        cm_timings.placement["TemplateTARGET"] += time.time() - t
         cm_timings.placementNum["TemplateTARGET"] += 1
+        self.inputs["Template"].batchBuild(newRequests, children)
 
     def check(self):
         if "Template" not in self.inputs:
@@ -1366,23 +1531,43 @@ class TemplateOBSTACLE(Template):
     def __init__(self, inputs, settings, bpyName):
         Template.__init__(self, inputs, settings, bpyName)
         self.octree = None
+        self.sceneMin = None
+        self.sceneMax = None
 
-    def build(self, buildRequest):
+    def buildOnce(self, buildRequest, children):
         t = time.time()
         if self.octree is None:
             objs = bpy.data.groups[self.settings["obstacleGroup"]].objects
             margin = self.settings["margin"]
             mVec = Vector((margin, margin, margin))
-            radii = [(o.dimensions / 2) + mVec for o in objs]
-            self.octree = createOctreeFromBPYObjs(objs, allSpheres=False,
-                                                  radii=radii)
-        intersections = self.octree.checkPoint(buildRequest.pos)
+            bbs = [boundingBoxFromBPY(o, overwriteRadii=(o.dimensions / 2) + mVec)
+                   for o in objs]
+            self.octree = createOctree(bbs)
+            # Box around all the obstacles. Points outside it can't intersect
+            #   any of them so the octree doesn't need to be checked
+            if len(bbs) > 0:
+                self.sceneMin = tuple(min(b.pos[i] - b.dim[i] for b in bbs)
+                                      for i in range(3))
+                self.sceneMax = tuple(max(b.pos[i] + b.dim[i] for b in bbs)
+                                      for i in range(3))
+            else:
+                self.sceneMin = (math.inf, math.inf, math.inf)
+                self.sceneMax = (-math.inf, -math.inf, -math.inf)
+
+        p = buildRequest.pos
+        sMin = self.sceneMin
+        sMax = self.sceneMax
+        if (sMin[0] <= p[0] <= sMax[0] and sMin[1] <= p[1] <= sMax[1] and
+                sMin[2] <= p[2] <= sMax[2]):
+            intersections = self.octree.checkPoint(p)
+        else:
+            intersections = ()
 
         cm_timings.placement["TemplateOBSTACLE"] += time.time() - t
         cm_timings.placementNum["TemplateOBSTACLE"] += 1
 
         if len(intersections) == 0:
-            self.inputs["Template"].build(buildRequest)
+            children.append((self.inputs["Template"], buildRequest))
 
     def check(self):
         if "Template" not in self.inputs:
@@ -1402,49 +1587,72 @@ class TemplateGROUND(Template):
     def __init__(self, inputs, settings, bpyName):
         Template.__init__(self, inputs, settings, bpyName)
         self.bvhtree = None
-
-    def build(self, buildRequest):
-        t = time.time()
-        sce = bpy.context.scene
-        gnd = sce.objects[self.settings["groundMesh"]]
+        self.worldTransform = None
+        self.inverseTransform = None
+        self.rayDown = None
+        self.rayUp = None
+
+    def updateGround(self):
+        """Build the BVHTree and the cached transforms the first time the
+        ground is needed. Templates are reconstructed for every generate so
+        they never need rebuilding"""
         if self.bvhtree is None:
+            sce = bpy.context.scene
+            gnd = sce.objects[self.settings["groundMesh"]]
             self.bvhtree = BVHTree.FromObject(gnd, sce)
+            self.worldTransform = gnd.matrix_world.copy()
+            self.inverseTransform = gnd.matrix_world.inverted()
+            direc = Vector((0, 0, 1))
+            direc.rotate(self.inverseTransform.to_euler())
+            self.rayDown = tuple(-x for x in direc)
+            self.rayUp = tuple(direc)
+
+    def buildOnce(self, buildRequest, children):
+        self.batchBuild([buildRequest], children)
+
+    def batchBuild(self, requests, children):
+        """Move each request in requests onto the ground and add the ones
+        that hit it to children. Lets templates that make many requests at
+        once ground them without going through buildOnce for each"""
+        t = time.time()
+        self.updateGround()
 
-        inverseTransform = gnd.matrix_world.inverted()
-        point = (inverseTransform * buildRequest.pos.to_4d()).to_3d()
-        direc = Vector((0, 0, 1))
-        direc.rotate(inverseTransform.to_euler())
-
-        hitA, normA, indA, distA = self.bvhtree.ray_cast(point,
-                                                         tuple(-x for x in direc))
-        if hitA is not None:
-            hitA = gnd.matrix_world * hitA
-            normA = gnd.matrix_world * normA
-            distA = (buildRequest.pos - hitA).length
-
-        hitB, normB, indB, distB = self.bvhtree.ray_cast(point,
-                                                         tuple(x for x in direc))
-        if hitB is not None:
-            hitB = gnd.matrix_world * hitB
-            normB = gnd.matrix_world * normB
-            distB = (buildRequest.pos - hitB).length
+        rayCast = self.bvhtree.ray_cast
+        worldTransform = self.worldTransform
+        inverseTransform = self.inverseTransform
+        rayDown = self.rayDown
+        rayUp = self.rayUp
+        template = self.inputs["Template"]
 
-        cm_timings.placement["TemplateGROUND"] += time.time() - t
-        cm_timings.placementNum["TemplateGROUND"] += 1
+        grounded = []
+        for buildRequest in requests:
+            pos = buildRequest.pos
+            point = inverseTransform * pos
+
+            hitA = rayCast(point, rayDown)[0]
+            if hitA is not None:
+                hitA = worldTransform * hitA
+                distA = (pos - hitA).length
+
+            hitB = rayCast(point, rayUp)[0]
+            if hitB is not None:
+                hitB = worldTransform * hitB
+                distB = (pos - hitB).length
 
-        if hitA and hitB:
-            if distA <= distB:
+            if hitA is not None and hitB is not None:
+                buildRequest.pos = hitA if distA <= distB else hitB
+            elif hitA is not None:
                 buildRequest.pos = hitA
-                self.inputs["Template"].build(buildRequest)
-            else:
+            elif hitB is not None:
                 buildRequest.pos = hitB
-                self.inputs["Template"].build(buildRequest)
-        elif hitA:
-            buildRequest.pos = hitA
-            self.inputs["Template"].build(buildRequest)
-        elif hitB:
-            buildRequest.pos = hitB
-            self.inputs["Template"].build(buildRequest)
+            else:
+                continue
+            grounded.append((template, buildRequest))
+
+        cm_timings.placement["TemplateGROUND"] += time.time() - t
+        cm_timings.placementNum["TemplateGROUND"] += len(requests)
+
+        children.extend(grounded)
 
     def check(self):
         if self.settings["groundMesh"] not in bpy.context.scene.objects:
@@ -1461,9 +1669,9 @@ class TemplateGROUND(Template):
 class TemplateSETTAG(Template):
     """Set a tag for an agent to start with"""
 
-    def build(self, buildRequest):
-        buildRequest.tags[self.settings["tagName"]] = self.settings["tagValue"]
-        self.inputs["Template"].build(buildRequest)
+    def buildOnce(self, buildRequest, children):
+        buildRequest.setTag(self.settings["tagName"], self.settings["tagValue"])
+        children.append((self.inputs["Template"], buildRequest))
 
     def check(self):
         if "Template" not in self.inputs:
@@ -23,6 +23,7 @@ import bpy
 from bpy.types import Operator
 
 from .cm_syncManager import SyncManagerTestCase
+from .libs.ins_relax import RelaxPointsTestCase
 
 
 class AddonRegisterTestCase(unittest.TestCase):
@@ -65,6 +66,7 @@ def createShortTestSuite():
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(AddonRegisterTestCase))
     test_suite.addTest(unittest.makeSuite(SyncManagerTestCase))
+    test_suite.addTest(unittest.makeSuite(RelaxPointsTestCase))
     return test_suite
 
 
@@ -55,6 +55,7 @@ class Crowdmaster_place_deferred_geo(Operator):
                             for m in newObj.material_slots:
                                 if m.name in materials:
                                     replacement = materials[m.name]
+                                    m.link = 'OBJECT'
                                     m.material = D.materials[replacement]
 
                             child = False
@@ -120,6 +121,7 @@ class Crowdmaster_place_deferred_geo(Operator):
                                     for m in nObj.material_slots:
                                         if m.name in materials:
                                             replacement = materials[m.name]
+                                            m.link = 'OBJECT'
                                             m.material = D.materials[replacement]
 
         return {'FINISHED'}
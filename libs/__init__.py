@@ -36,4 +36,9 @@ try:
 except Exception:
     logger.error("ERROR importing ins_octree")
 
+try:
+    from . import ins_relax
+except Exception:
+    logger.error("ERROR importing ins_relax")
+
 from . import cm_draw
@@ -0,0 +1,197 @@
+# Copyright 2017 CrowdMaster Developer Team
+#
+# ##### BEGIN GPL LICENSE BLOCK ######
+# This file is part of CrowdMaster.
+#
+# CrowdMaster is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# CrowdMaster is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with CrowdMaster.  If not, see <http://www.gnu.org/licenses/>.
+# ##### END GPL LICENSE BLOCK #####
+
+"""Relaxation of point sets used when placing agents. Only depends on NumPy
+(and optionally numba) so that it can be used and tested outside Blender.
+"""
+
+import math
+import unittest
+
+import numpy as np
+
+try:
+    from mathutils.kdtree import KDTree
+except ImportError:
+    KDTree = None
+
+# Replaced by numba.prange when relaxPointsGrid is compiled
+prange = range
+
+# Compiling relaxPointsGrid takes several seconds the first time it is used
+#   so it is only worth using for this many points or more
+GRID_RELAX_MIN_POINTS = 2000
+
+# None until compileRelaxPointsGrid has been called, False if numba is missing
+compiledRelaxPointsGrid = None
+
+
+def rotatePoints(points, rotMatrix):
+    """Rotate each row of an (N, 3) array by the same 3x3 rotation matrix"""
+    return np.dot(points, np.array(rotMatrix).T)
+
+
+def relaxPointsGrid(points, radius, iterations):
+    """Same as relaxPoints but finds neighbours by bucketing the points into
+    a uniform grid with cells 2 * radius wide. Compiled with numba when it
+    is installed, as mathutils.kdtree can't be called from compiled code"""
+    n = points.shape[0]
+    diameter = 2 * radius
+    cells = np.empty((n, 3), np.int64)
+    keys = np.empty(n, np.int64)
+    for it in range(iterations):
+        start = points.copy()
+        low = start[0].copy()
+        for i in range(n):
+            for d in range(3):
+                low[d] = min(low[d], start[i, d])
+        # Cells are offset by one so that neighbouring cells are never negative
+        high = np.zeros(3, np.int64)
+        for i in range(n):
+            for d in range(3):
+                c = int(math.floor((start[i, d] - low[d]) / diameter)) + 1
+                cells[i, d] = c
+                high[d] = max(high[d], c)
+        ny = high[1] + 2
+        nz = high[2] + 2
+        for i in range(n):
+            keys[i] = (cells[i, 0] * ny + cells[i, 1]) * nz + cells[i, 2]
+        order = np.argsort(keys)
+        sortedKeys = keys[order]
+
+        for i in prange(n):
+            adjust = np.zeros(3)
+            count = 0
+            for dx in range(-1, 2):
+                for dy in range(-1, 2):
+                    for dz in range(-1, 2):
+                        k = ((cells[i, 0] + dx) * ny +
+                             (cells[i, 1] + dy)) * nz + (cells[i, 2] + dz)
+                        first = np.searchsorted(sortedKeys, k)
+                        last = np.searchsorted(sortedKeys, k, side='right')
+                        for s in range(first, last):
+                            j = order[s]
+                            v = start[i] - start[j]
+                            length = math.sqrt(v[0] * v[0] + v[1] * v[1] +
+                                               v[2] * v[2])
+                            if length <= diameter:
+                                count += 1
+                                if j != i and length > 0:
+                                    adjust += v * ((diameter - length) / length)
+            if count > 0:
+                points[i] += adjust / count
+    return points
+
+
+def compileRelaxPointsGrid():
+    """Compile relaxPointsGrid with numba the first time it is needed.
+    numba is imported here rather than at the top of the module so that
+    loading the addon doesn't pay for importing it. Returns None if numba
+    isn't installed"""
+    global compiledRelaxPointsGrid, prange
+    if compiledRelaxPointsGrid is None:
+        try:
+            import numba
+        except ImportError:
+            compiledRelaxPointsGrid = False
+        else:
+            prange = numba.prange
+            compiledRelaxPointsGrid = numba.njit(cache=True,
+                                                 parallel=True)(relaxPointsGrid)
+    if compiledRelaxPointsGrid is False:
+        return None
+    return compiledRelaxPointsGrid
+
+
+def relaxPoints(points, radius, iterations):
+    """Push apart points in an (N, 3) array that are closer than 2 * radius.
+    The points are adjusted in place. For large arrays, when numba is
+    installed, neighbours are found with the compiled relaxPointsGrid.
+    Otherwise they are found with a KDTree built at the start of each
+    iteration"""
+    n = len(points)
+    if n < 2 or radius <= 0:
+        return points
+    if n >= GRID_RELAX_MIN_POINTS or KDTree is None:
+        compiled = compileRelaxPointsGrid()
+        if compiled is not None:
+            return compiled(points, radius, iterations)
+        if KDTree is None:
+            return relaxPointsGrid(points, radius, iterations)
+    diameter = 2 * radius
+    for i in range(iterations):
+        start = points.copy()
+        kd = KDTree(n)
+        for ind, p in enumerate(start):
+            kd.insert(p, ind)
+        kd.balance()
+        for ind in range(n):
+            localPoints = kd.find_range(start[ind], diameter)
+            idxs = [j for (co, j, dist) in localPoints if j != ind]
+            if len(idxs) == 0:
+                continue
+            diffs = points[ind] - start[idxs]
+            lens = np.linalg.norm(diffs, axis=1)
+            near = lens > 0
+            diffs = diffs[near]
+            lens = lens[near]
+            adjust = (diffs * ((diameter - lens) / lens)[:, None]).sum(axis=0)
+            points[ind] += adjust / len(localPoints)
+    return points
+
+
+def relaxPointsBruteForce(points, radius, iterations):
+    """Reference version of relaxPoints that compares every pair of points"""
+    diameter = 2 * radius
+    for it in range(iterations):
+        start = points.copy()
+        for i in range(len(points)):
+            diffs = start[i] - start
+            lens = np.linalg.norm(diffs, axis=1)
+            near = lens <= diameter
+            push = near & (lens > 0)
+            adjust = (diffs[push] *
+                      ((diameter - lens[push]) / lens[push])[:, None]).sum(axis=0)
+            points[i] += adjust / near.sum()
+    return points
+
+
+class RelaxPointsTestCase(unittest.TestCase):
+    def compareToBruteForce(self, number, relax):
+        rand = np.random.RandomState(number)
+        points = rand.uniform(-10, 10, (number, 3))
+        points[:, 2] *= 0.1
+        expected = relaxPointsBruteForce(points.copy(), 0.5, 3)
+        result = relax(points.copy(), 0.5, 3)
+        self.assertTrue(np.allclose(result, expected, rtol=0, atol=1e-9))
+
+    def testGrid(self):
+        for number in (50, 500, 3000):
+            self.compareToBruteForce(number, relaxPointsGrid)
+
+    def testCompiledGrid(self):
+        compiled = compileRelaxPointsGrid()
+        if compiled is None:
+            self.skipTest("numba is not installed")
+        for number in (50, 500, 3000):
+            self.compareToBruteForce(number, compiled)
+
+    def testRelaxPoints(self):
+        for number in (50, 500, 3000):
+            self.compareToBruteForce(number, relaxPoints)